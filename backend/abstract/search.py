@@ -303,7 +303,7 @@ class Search(BasicProcessor, ABC):
 			check_cache = CheckCache(hash_cache, hasher)
 
 		processed = 0
-		with filepath.open("w", encoding="utf-8", newline="") as outfile:
+		with filepath.open("w", encoding="utf-8", newline="", buffering=1024 * 1024) as outfile:
 			for item in items:
 				if self.interrupted:
 					raise ProcessorInterruptedException("Interrupted while writing results to file")
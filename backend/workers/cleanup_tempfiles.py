@@ -37,6 +37,11 @@ class TempFileCleaner(BasicWorker):
             if self.interrupted:
                 raise WorkerInterruptedException("Interrupted while cleaning up orphaned result files")
 
+            # hidden files are not result files, but e.g. caches kept by
+            # processors
+            if file.name.startswith("."):
+                continue
+
             # the key of the dataset files belong to can be extracted from the
             # file name in a predictable way.
             possible_keys = re.findall(r"[abcdef0-9]{32}", file.stem)
@@ -1,9 +1,11 @@
 """ 4CAT configuration """
 import os
 import json
+import time
 from pathlib import Path
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import configparser
 
 from common.lib.exceptions import ConfigException
@@ -25,31 +27,169 @@ class ConfigManager:
     USING_DOCKER = False
     if CONFIG_FILE.exists():
         config_reader.read(CONFIG_FILE)
-        if config_reader["DOCKER"].getboolean("use_docker_config"):
+        if config_reader.has_section("DOCKER") and config_reader["DOCKER"].getboolean("use_docker_config"):
             # Can use throughtout 4CAT to know if Docker environment
             USING_DOCKER = True
     else:
         # config should be created!
         raise ConfigException("No config/config.ini file exists! Update and rename the config.ini-example file.")
 
-    DB_HOST = config_reader["DATABASE"].get("db_host")
-    DB_PORT = config_reader["DATABASE"].getint("db_port")
-    DB_USER = config_reader["DATABASE"].get("db_user")
-    DB_NAME = config_reader["DATABASE"].get("db_name")
-    DB_PASSWORD = config_reader["DATABASE"].get("db_password")
+    # read each section into a plain dictionary once, rather than going
+    # through configparser for every option
+    _database = dict(config_reader["DATABASE"]) if config_reader.has_section("DATABASE") else {}
+    _api = dict(config_reader["API"]) if config_reader.has_section("API") else {}
+    _paths = dict(config_reader["PATHS"]) if config_reader.has_section("PATHS") else {}
+    _generate = dict(config_reader["GENERATE"]) if config_reader.has_section("GENERATE") else {}
 
-    API_HOST = config_reader["API"].get("api_host")
-    API_PORT = config_reader["API"].getint("api_port")
+    DB_HOST = _database.get("db_host")
+    DB_PORT = int(_database["db_port"]) if _database.get("db_port") else None
+    DB_USER = _database.get("db_user")
+    DB_NAME = _database.get("db_name")
+    DB_PASSWORD = _database.get("db_password")
+
+    API_HOST = _api.get("api_host")
+    API_PORT = int(_api["api_port"]) if _api.get("api_port") else None
 
     PATH_ROOT = str(Path(os.path.abspath(os.path.dirname(__file__))).joinpath(".."))  # better don"t change this
-    PATH_LOGS = config_reader["PATHS"].get("path_logs", "")
-    PATH_IMAGES = config_reader["PATHS"].get("path_images", "")
-    PATH_DATA = config_reader["PATHS"].get("path_data", "")
-    PATH_LOCKFILE = config_reader["PATHS"].get("path_lockfile", "")
-    PATH_SESSIONS = config_reader["PATHS"].get("path_sessions", "")
+    PATH_LOGS = _paths.get("path_logs", "")
+    PATH_IMAGES = _paths.get("path_images", "")
+    PATH_DATA = _paths.get("path_data", "")
+    PATH_LOCKFILE = _paths.get("path_lockfile", "")
+    PATH_SESSIONS = _paths.get("path_sessions", "")
+
+    ANONYMISATION_SALT = _generate.get("anonymisation_salt")
+    SECRET_KEY = _generate.get("secret_key")
+
+    del _database, _api, _paths, _generate
+
+
+# names of the options above; get() checks this for every setting, and
+# dir() is too slow to call that often
+_CONFIG_ATTRIBUTES = frozenset(dir(ConfigManager))
+
+
+# settings read from the database are cached for a short while, so that
+# repeatedly reading the same setting does not need a query every time
+# the cache maps setting name -> (time cached, raw JSON value)
+_SETTINGS_CACHE = {}
+_CACHE_TTL = 30.0
+
+
+def invalidate_cache(attribute_name=None):
+    """
+    Clear cached setting values
+
+    Values are cached for a short time after they have been read from the
+    database. This clears that cache, so the next read gets a fresh value.
+
+    :param str attribute_name:  Setting to clear; if `None`, all cached
+    settings are cleared
+    """
+    if attribute_name is None:
+        _SETTINGS_CACHE.clear()
+    else:
+        _SETTINGS_CACHE.pop(attribute_name, None)
+
+
+# connections used to read and write settings are taken from a pool rather
+# than set up anew for every query; the pool is created on first use (and
+# re-created in forked processes, which should not share connections)
+_POOL = None
+_POOL_PID = None
+
+
+def _get_pool():
+    """
+    Get the connection pool for settings queries
+
+    :return psycopg2.pool.ThreadedConnectionPool:  Connection pool
+    """
+    global _POOL, _POOL_PID
+    if _POOL is None or _POOL_PID != os.getpid():
+        _POOL = psycopg2.pool.ThreadedConnectionPool(1, 16, dbname=ConfigManager.DB_NAME, user=ConfigManager.DB_USER,
+                                                     password=ConfigManager.DB_PASSWORD, host=ConfigManager.DB_HOST,
+                                                     port=ConfigManager.DB_PORT)
+        _POOL_PID = os.getpid()
+
+    return _POOL
+
+
+def _acquire_connection(connection=None, cursor=None):
+    """
+    Get a connection and cursor to run a settings query with
+
+    If no connection and cursor are provided, a connection is taken from the
+    pool.
+
+    :param connection:  Database connection to use, if any
+    :param cursor:  Database cursor to use, if any
+    :return tuple:  (connection, cursor, whether connection is pooled)
+    """
+    if connection and cursor:
+        return connection, cursor, False
+
+    try:
+        connection = _get_pool().getconn()
+    except psycopg2.pool.PoolError:
+        # all pooled connections are in use; rather than waiting for one,
+        # connect separately, as was done before there was a pool
+        connection, cursor = quick_db_connect()
+        return connection, cursor, False
+
+    return connection, connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor), True
 
-    ANONYMISATION_SALT = config_reader["GENERATE"].get("anonymisation_salt")
-    SECRET_KEY = config_reader["GENERATE"].get("secret_key")
+
+def _release_connection(connection, pooled, keep_connection_open=False):
+    """
+    Release a connection acquired with `_acquire_connection()`
+
+    :param connection:  Database connection
+    :param bool pooled:  Whether the connection was taken from the pool
+    :param bool keep_connection_open:  Leave a connection that was not taken
+    from the pool open?
+    """
+    if connection is None:
+        return
+
+    if pooled:
+        # the pool rolls back any open transaction
+        _get_pool().putconn(connection)
+    elif not keep_connection_open:
+        connection.close()
+
+
+def _run_query(callback, connection=None, cursor=None, keep_connection_open=False):
+    """
+    Run a settings query
+
+    Pooled connections may have been closed by the database in the meantime
+    (e.g. because it was restarted), which only becomes apparent when they
+    are used. If a query fails on a pooled connection because of that, it is
+    tried once more with a fresh connection.
+
+    :param callback:  Function that runs the query; called with a connection
+    and cursor, and its return value is returned
+    :param connection:  Database connection to use, if any
+    :param cursor:  Database cursor to use, if any
+    :param bool keep_connection_open:  Leave a connection that was not taken
+    from the pool open?
+    :return:  Return value of the callback
+    """
+    pooled = False
+    try:
+        connection, cursor, pooled = _acquire_connection(connection, cursor)
+        try:
+            return callback(connection, cursor)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not pooled:
+                raise
+
+            _get_pool().putconn(connection, close=True)
+            connection = None
+            connection, cursor, pooled = _acquire_connection()
+            return callback(connection, cursor)
+    finally:
+        _release_connection(connection, pooled, keep_connection_open)
 
 
 def quick_db_connect():
@@ -76,43 +216,40 @@ def get(attribute_name, default=None, connection=None, cursor=None, keep_connect
 
     :param str attribute_name:  Setting to return
     :param default:  Value to return if setting does not exist
-    :param connection:  Database connection, if None then a new connection will be created
+    :param connection:  Database connection, if None then a pooled connection will be used
     :param cursor:  Database cursor, if None then a new cursor will be created
     :param bool keep_connection_open:  Close connection after query?
     :param bool raw:  True returns value as JSON serialized string; False returns JSON object
     :return:  Setting value, or the provided fallback, or `None`.
     """
-    if attribute_name in dir(ConfigManager):
+    if attribute_name in _CONFIG_ATTRIBUTES:
         # an explicitly defined attribute should always be called in favour
         # of this passthrough
         attribute = getattr(ConfigManager, attribute_name)
         return attribute
+    elif attribute_name in _SETTINGS_CACHE and time.monotonic() - _SETTINGS_CACHE[attribute_name][0] < _CACHE_TTL:
+        value = _SETTINGS_CACHE[attribute_name][1]
     else:
-        try:
-            if not connection or not cursor:
-                connection, cursor = quick_db_connect()
-
+        def query_setting(connection, cursor):
             query = "SELECT value FROM settings WHERE name = %s"
             cursor.execute(query, (attribute_name,))
             row = cursor.fetchone()
+            return row.get("value", None) if row else None
 
-            if not keep_connection_open:
-                connection.close()
-
-            value = row.get("value", None) if row else None
-            if not raw and value is not None:
-                value = json.loads(value)
+        try:
+            value = _run_query(query_setting, connection, cursor, keep_connection_open)
+            _SETTINGS_CACHE[attribute_name] = (time.monotonic(), value)
         except (Exception, psycopg2.DatabaseError) as error:
             raise ConfigException("Error getting setting {}: {}".format(attribute_name, repr(error)))
 
-        finally:
-            if connection is not None and not keep_connection_open:
-                connection.close()
+    # values are cached as JSON, so callers cannot modify the cached value
+    if not raw and value is not None:
+        value = json.loads(value)
 
-        if value is None:
-            return default
-        else:
-            return value
+    if value is None:
+        return default
+    else:
+        return value
 
 
 def get_all(connection=None, cursor=None, keep_connection_open=False, raw=False):
@@ -121,37 +258,33 @@ def get_all(connection=None, cursor=None, keep_connection_open=False, raw=False)
     while other attributes (part of the ConfigManager class are not directly
     editable)
 
-    :param connection: Database connection, if None then a new connection will
-    be created
+    :param connection: Database connection, if None then a pooled connection
+    will be used
     :param cursor: Database cursor, if None then a new cursor will be created
     :param keep_connection_open: Close connection after query?
     :param bool raw:  True returns values as JSON serialized strings; False returns JSON objects
     :return dict:  Settings, as setting -> value. Values are decoded from JSON
     """
-    try:
-        if not connection or not cursor:
-            connection, cursor = quick_db_connect()
-
+    def query_settings(connection, cursor):
         query = "SELECT name, value FROM settings"
         cursor.execute(query)
-        rows = cursor.fetchall()
+        return cursor.fetchall()
 
-        if not keep_connection_open:
-            connection.close()
+    try:
+        rows = _run_query(query_settings, connection, cursor, keep_connection_open)
 
         values = {}
+        cached_at = time.monotonic()
         for row in rows:
             value = row.get("value", None) if row else None
+            # get() calls for these settings can now use the cache as well
+            _SETTINGS_CACHE[row["name"]] = (cached_at, value)
             if not raw and value is not None:
                 value = json.loads(value)
             values[row["name"]] = value
     except (Exception, psycopg2.DatabaseError) as error:
         raise ConfigException("Error getting settings: {}".format(repr(error)))
 
-    finally:
-        if connection is not None and not keep_connection_open:
-            connection.close()
-
     return values
 
 
@@ -167,7 +300,7 @@ def set_or_create_setting(attribute_name, value, raw, overwrite_existing=True, c
     :param bool raw:  True for a value that is already a serialised JSON string; False if value is object that needs to
                       be serialised into a JSON string
     :param bool overwrite_existing: True will overwrite existing setting, False will do nothing if setting exists
-    :param connection: Database connection, if None then a new connection will be created
+    :param connection: Database connection, if None then a pooled connection will be used
     :param cursor: Database cursor, if None then a new cursor will be created
     :param keep_connection_open: Close connection after query?
     :return int: number of updated rows
@@ -184,10 +317,7 @@ def set_or_create_setting(attribute_name, value, raw, overwrite_existing=True, c
         except json.JSONDecodeError:
             return None
 
-    try:
-        if not connection or not cursor:
-            connection, cursor = quick_db_connect()
-
+    def update_setting(connection, cursor):
         if overwrite_existing:
             query = "INSERT INTO settings (name, value) Values (%s, %s) ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value"
         else:
@@ -195,15 +325,13 @@ def set_or_create_setting(attribute_name, value, raw, overwrite_existing=True, c
         cursor.execute(query, (attribute_name, value))
         updated_rows = cursor.rowcount
         connection.commit()
+        return updated_rows
 
-        if not keep_connection_open:
-            connection.close()
+    try:
+        updated_rows = _run_query(update_setting, connection, cursor, keep_connection_open)
+        invalidate_cache(attribute_name)
 
     except (Exception, psycopg2.DatabaseError) as error:
         raise ConfigException("Error setting setting {}: {}".format(attribute_name, repr(error)))
 
-    finally:
-        if connection is not None and not keep_connection_open:
-            connection.close()
-
     return updated_rows
@@ -271,15 +271,34 @@ class DataSet(FourcatModule):
 			if hasattr(own_processor, "map_item") and extension_fits:
 				item_mapper = own_processor.map_item
 
+		# this is checked for every item, so only look up once whether the
+		# processor can be interrupted at all
+		interruptible = hasattr(processor, "interrupted")
+
 		# go through items one by one, optionally mapping them
+		# result files can be large, so read them in bigger chunks than the
+		# default buffer size
 		if path.suffix.lower() == ".csv":
-			with path.open(encoding="utf-8") as infile:
-				reader = csv.DictReader(infile)
-
-				for item in reader:
-					if hasattr(processor, "interrupted") and processor.interrupted:
+			with path.open(encoding="utf-8", newline="", buffering=1024 * 1024) as infile:
+				# this does what csv.DictReader does, but without its
+				# per-row overhead, since this loop runs for every item
+				reader = csv.reader(infile)
+				fieldnames = next(reader, [])
+				num_fields = len(fieldnames)
+
+				for row in reader:
+					if interruptible and processor.interrupted:
 						raise ProcessorInterruptedException("Processor interrupted while iterating through CSV file")
 
+					if not row:
+						continue
+
+					item = dict(zip(fieldnames, row))
+					if len(row) > num_fields:
+						item[None] = row[num_fields:]
+					elif len(row) < num_fields:
+						item.update(dict.fromkeys(fieldnames[len(row):]))
+
 					if item_mapper:
 						item = item_mapper(item)
 
@@ -288,9 +307,14 @@ class DataSet(FourcatModule):
 		elif path.suffix.lower() == ".ndjson":
 			# in this format each line in the file is a self-contained JSON
 			# file
-			with path.open(encoding="utf-8") as infile:
+			with path.open(encoding="utf-8", buffering=1024 * 1024) as infile:
+				if not item_mapper and not interruptible:
+					# nothing to do per item but decoding it
+					yield from map(json.loads, infile)
+					return
+
 				for line in infile:
-					if hasattr(processor, "interrupted") and processor.interrupted:
+					if interruptible and processor.interrupted:
 						raise ProcessorInterruptedException("Processor interrupted while iterating through NDJSON file")
 
 					item = json.loads(line)
@@ -2,6 +2,7 @@
 Search Telegram via API
 """
 import traceback
+import functools
 import binascii
 import datetime
 import hashlib
@@ -25,6 +26,78 @@ from telethon.tl.types import User
 
 import common.config_manager as config
 
+# serialize_obj() determines how to serialize a value based on its type; this
+# is determined once per type and then cached here
+_SCALARS = (int, str, float, list, tuple, set, bool)
+_SERIALIZE_KINDS = {}
+_KIND_SKIP, _KIND_VALUE, _KIND_TIMESTAMP, _KIND_HEX, _KIND_LIST, _KIND_STRUCT = range(6)
+
+# used to split queries into separate entities; any whitespace or comma
+# separates entities
+_QUERY_SEPARATORS = str.maketrans({character: "," for character in " \t\n\r\f\v"})
+# entities may also be given as t.me URLs; this extracts the entity name
+_ENTITY_NAME_RE = re.compile(r"^(?:https?://t\.me/)?(?:/?s/)?(.*?)/*$")
+
+# attachment types, as recorded in the result file
+_MEDIA_TYPES = {
+    "NoneType": "",
+    "MessageMediaContact": "contact",
+    "MessageMediaDocument": "document",
+    "MessageMediaEmpty": "",
+    "MessageMediaGame": "game",
+    "MessageMediaGeo": "geo",
+    "MessageMediaGeoLive": "geo_live",
+    "MessageMediaInvoice": "invoice",
+    "MessageMediaPhoto": "photo",
+    "MessageMediaPoll": "poll",
+    "MessageMediaUnsupported": "unsupported",
+    "MessageMediaVenue": "venue",
+    "MessageMediaWebPage": "url"
+}
+
+
+def _get_serialize_kind(value_type):
+    """
+    Determine how values of a given type should be serialized
+
+    :param type value_type:  Type of value
+    :return int:  One of the `_KIND_*` constants
+    """
+    module = value_type.__module__
+    if value_type is datetime:
+        return _KIND_TIMESTAMP
+    elif module in ("telethon.tl.types", "telethon.tl.custom.forward"):
+        return _KIND_STRUCT
+    elif value_type is list:
+        return _KIND_LIST
+    elif module[0:8] == "telethon":
+        # some type of internal telethon struct
+        return _KIND_SKIP
+    elif value_type is bytes:
+        return _KIND_HEX
+    elif value_type in _SCALARS or value_type is type(None):
+        return _KIND_VALUE
+    else:
+        # type we can't make sense of here
+        return _KIND_SKIP
+
+
+@functools.lru_cache(maxsize=65536)
+def _format_timestamp(timestamp):
+    """
+    Format a unix timestamp as a date string
+
+    Messages in a channel are often posted around the same time, so this is
+    cached rather than formatting every timestamp in every message. The date
+    is formatted from a plain `time.struct_time`, which is quite a bit
+    cheaper than creating a datetime object and calling strftime() on it.
+
+    :param timestamp:  Unix timestamp
+    :return str:  Formatted date, e.g. `2021-08-01 12:00:00`
+    """
+    return "%04d-%02d-%02d %02d:%02d:%02d" % time.localtime(timestamp)[:6]
+
+
 class SearchTelegram(Search):
     """
     Search Telegram via API
@@ -46,6 +119,9 @@ class SearchTelegram(Search):
 
     max_workers = 1
     max_retries = 3
+    max_concurrent_entities = 4  # entities to collect messages for at the same time
+    no_additional_queries = False
+    last_status_update = 0
 
     options = {
         "intro": {
@@ -137,18 +213,38 @@ class SearchTelegram(Search):
         Execute a query; get messages for given parameters
 
         Basically a wrapper around execute_queries() to call it with asyncio.
+        Messages are yielded as they are collected, so they can be written to
+        the results file straight away rather than all being kept in memory
+        until collection has finished.
 
         :param dict query:  Query parameters, as part of the DataSet object
-        :return list:  Posts, sorted by thread and post ID, in ascending order
+        :return Generator:  Posts, in reverse chronological order per entity
         """
         if "api_phone" not in query or "api_hash" not in query or "api_id" not in query:
             self.dataset.update_status("Could not create dataset since the Telegram API Hash and ID are missing. Try "
                                        "creating it again from scratch.", is_final=True)
-            return None
+            return
 
         self.details_cache = {}
         self.failures_cache = set()
-        results = asyncio.run(self.execute_queries())
+
+        # drive the async generator from here, one message at a time
+        self.eventloop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.eventloop)
+        messages = self.execute_queries()
+        try:
+            while True:
+                try:
+                    yield self.eventloop.run_until_complete(messages.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            # make sure the client is disconnected, even if we stopped early
+            self.eventloop.run_until_complete(messages.aclose())
+            self.eventloop.run_until_complete(self.eventloop.shutdown_asyncgens())
+            self.eventloop.close()
+            asyncio.set_event_loop(None)
+            self.eventloop = None
 
         if not query.get("save-session"):
             self.dataset.delete_parameter("api_hash", instant=True)
@@ -159,8 +255,6 @@ class SearchTelegram(Search):
             self.dataset.update_status("Dataset completed, but some requested entities were unavailable (they may have"
                                        "been private). View the log file for details.", is_final=True)
 
-        return results
-
     async def execute_queries(self):
         """
         Get messages for queries
@@ -169,15 +263,14 @@ class SearchTelegram(Search):
         Telethon's architecture this needs to be called in an async method,
         which is this one.
 
-        :return list:  Collected messages
+        :return AsyncGenerator:  Collected messages
         """
         # session file has been created earlier, and we can re-use it here in
         # order to avoid having to re-enter the security code
         query = self.parameters
 
-        session_id = SearchTelegram.create_session_id(query["api_phone"], query["api_id"], query["api_hash"])
-        self.dataset.log('Telegram session id: %s' % session_id)
-        session_path = Path(config.get("PATH_ROOT")).joinpath(config.get("PATH_SESSIONS"), session_id + ".session")
+        session_path = SearchTelegram.get_session_path(query["api_phone"], query["api_id"], query["api_hash"])
+        self.dataset.log('Telegram session id: %s' % session_path.stem)
 
         client = None
 
@@ -199,7 +292,7 @@ class SearchTelegram(Search):
             if session_path.exists():
                 session_path.unlink()
 
-            return []
+            return
         except Exception as e:
             # not sure what exception specifically is triggered here, but it
             # always means the connection failed
@@ -207,7 +300,7 @@ class SearchTelegram(Search):
             self.dataset.update_status("Error connecting to the Telegram API with provided credentials.", is_final=True)
             if client and hasattr(client, "disconnect"):
                 await client.disconnect()
-            return []
+            return
 
         # ready our parameters
         parameters = self.dataset.get_parameters()
@@ -230,26 +323,42 @@ class SearchTelegram(Search):
             except ValueError:
                 min_date = None
 
-        posts = []
+        posts = self.gather_posts(client, queries, max_items, min_date, max_date)
         try:
-            async for post in self.gather_posts(client, queries, max_items, min_date, max_date):
-                posts.append(post)
-            return posts
+            async for post in posts:
+                yield post
         except ProcessorInterruptedException as e:
             raise e
         except Exception as e:
             # catch-all so we can disconnect properly
             # ...should we?
-            self.dataset.update_status("Error scraping posts from Telegram")
+            # messages collected up to this point have already been written
+            # to the results file, so the dataset is kept, but this status is
+            # final so it is not replaced by the generic 'query finished' one
+            self.dataset.update_status("Error scraping posts from Telegram; the dataset only contains the messages "
+                                       "collected before the error occurred.", is_final=True)
             self.log.error("Telegram scraping error: %s" % traceback.format_exc())
-            return []
         finally:
+            # if we stopped early, `async for` leaves gather_posts() suspended;
+            # close it so its collectors are cancelled before disconnecting
+            await posts.aclose()
+
+            # the client is not kept around for later jobs with the same
+            # credentials: it is tied to this job's event loop, and the same
+            # session file is also opened by the web tool (when logging in)
+            # and the image downloader, which would conflict with a client
+            # that is still connected with it
             await client.disconnect()
 
     async def gather_posts(self, client, queries, max_items, min_date, max_date):
         """
         Gather messages for each entity for which messages are requested
 
+        Messages are collected for multiple entities at the same time (up to
+        `max_concurrent_entities`), so that waiting for the API for one
+        entity does not hold up the others. Messages are yielded as they come
+        in, so messages from different entities may be interleaved.
+
         :param TelegramClient client:  Telegram Client
         :param list queries:  List of entities to query (as string)
         :param int max_items:  Messages to scrape per entity
@@ -257,110 +366,176 @@ class SearchTelegram(Search):
         :param int max_date:  Datetime date to get posts before
         :return list:  List of messages, each message a dictionary.
         """
-        resolve_refs = self.parameters.get("resolve-entities")
-
         # Adding flag to stop; using for rate limits
-        no_additional_queries = False
+        self.no_additional_queries = False
 
-        # Collect queries
-        processed = 0
-        for query in queries:
-            delay = 10
-            retries = 0
-            processed += 1
-            self.dataset.update_progress(processed / len(queries))
-
-            if no_additional_queries:
-                # Note that we are note completing this query
-                self.dataset.update_status("Rate-limited by Telegram; not executing query %s" % query)
-                continue
+        # collectors put messages in this queue, and this method yields them
+        # from there; `None` signals that a collector is done
+        messages = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.max_concurrent_entities)
 
-            while True:
-                self.dataset.update_status("Fetching messages for entity '%s'" % query)
-                i = 0
+        async def collect(query):
+            async with semaphore:
                 try:
-                    entity_posts = 0
-                    async for message in client.iter_messages(entity=query, offset_date=max_date):
-                        entity_posts += 1
-                        i += 1
-                        if self.interrupted:
-                            raise ProcessorInterruptedException(
-                                "Interrupted while fetching message data from the Telegram API")
+                    async for message in self.gather_entity_posts(client, query, max_items, min_date, max_date):
+                        messages.put_nowait(message)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # re-raised below
+                    messages.put_nowait(e)
+                finally:
+                    messages.put_nowait(None)
+
+        collectors = [asyncio.ensure_future(collect(query)) for query in queries]
 
-                        if entity_posts % 100 == 0:
-                            self.dataset.update_status(
-                                "Retrieved %i posts for entity '%s' (%i total)" % (entity_posts, query, i))
+        # Collect queries
+        processed = 0
+        try:
+            while processed < len(collectors):
+                message = await messages.get()
+                if message is None:
+                    processed += 1
+                    self.dataset.update_progress(processed / len(queries))
+                elif isinstance(message, Exception):
+                    raise message
+                else:
+                    yield message
+        finally:
+            for collector in collectors:
+                collector.cancel()
 
-                        if message.action is not None:
-                            # e.g. someone joins the channel - not an actual message
-                            continue
+            await asyncio.gather(*collectors, return_exceptions=True)
 
-                        # todo: possibly enrich object with e.g. the name of
-                        # the channel a message was forwarded from (but that
-                        # needs extra API requests...)
-                        serialized_message = SearchTelegram.serialize_obj(message)
-                        if resolve_refs:
-                            serialized_message = await self.resolve_groups(client, serialized_message)
+    async def gather_entity_posts(self, client, query, max_items, min_date, max_date):
+        """
+        Gather messages for a single entity
 
-                        # Stop if we're below the min date
-                        if min_date and serialized_message.get("date") < min_date:
-                            break
+        :param TelegramClient client:  Telegram Client
+        :param str query:  Entity to query
+        :param int max_items:  Messages to scrape for the entity
+        :param int min_date:  Datetime date to get posts after
+        :param int max_date:  Datetime date to get posts before
+        :return AsyncGenerator:  Messages, each message a dictionary.
+        """
+        resolve_refs = self.parameters.get("resolve-entities")
 
-                        yield serialized_message
+        delay = 10
+        retries = 0
 
-                        if entity_posts >= max_items:
-                            break
+        if self.no_additional_queries:
+            # Note that we are note completing this query
+            self.dataset.update_status("Rate-limited by Telegram; not executing query %s" % query)
+            return
 
-                except ChannelPrivateError:
-                    self.dataset.update_status("Entity %s is private, skipping" % query)
-                    self.flawless = False
+        # when trying again after a timeout or rate limit, continue where we
+        # left off rather than collecting the same messages again
+        entity_posts = 0
+        offset_id = 0
 
-                except (UsernameInvalidError,):
-                    self.dataset.update_status("Could not scrape entity '%s', does not seem to exist, skipping" % query)
-                    self.flawless = False
+        while True:
+            self.dataset.update_status("Fetching messages for entity '%s'" % query)
+            i = 0
+            try:
+                # passing the limit lets Telethon size its requests (of at
+                # most 100 messages each) to what we need; without it, it
+                # also waits a second between every request
+                async for message in client.iter_messages(entity=query, offset_date=max_date, offset_id=offset_id,
+                                                          limit=max_items - entity_posts):
+                    i += 1
+                    if self.interrupted:
+                        raise ProcessorInterruptedException(
+                            "Interrupted while fetching message data from the Telegram API")
+
+                    # status updates are database writes, so limit them to one
+                    # per second (across all entities being collected)
+                    if time.monotonic() - self.last_status_update > 1:
+                        self.dataset.update_status(
+                            "Retrieved %i posts for entity '%s' (%i total)" % (entity_posts, query, i))
+                        self.last_status_update = time.monotonic()
+
+                    # Stop if we're below the min date
+                    # this is checked before serializing the message (and
+                    # resolving its references, which needs more requests)
+                    # so no work is wasted on a message that is not kept
+                    if min_date and message.date and message.date.timestamp() < min_date:
+                        break
 
-                except FloodWaitError as e:
-                    self.dataset.update_status("Rate-limited by Telegram: %s; waiting" % str(e))
-                    if e.seconds < self.end_if_rate_limited:
-                        time.sleep(e.seconds)
+                    if message.action is not None:
+                        # e.g. someone joins the channel - not an actual message
+                        offset_id = message.id
+                        entity_posts += 1
                         continue
-                    else:
-                        self.flawless = False
-                        no_additional_queries = True
-                        self.dataset.update_status("Telegram wait grown large than %i minutes, ending" % int(e.seconds/60))
+
+                    # todo: possibly enrich object with e.g. the name of
+                    # the channel a message was forwarded from (but that
+                    # needs extra API requests...)
+                    serialized_message = SearchTelegram.serialize_obj(message)
+                    if resolve_refs:
+                        serialized_message = await self.resolve_groups(client, serialized_message)
+
+                    yield serialized_message
+
+                    # only now is the message done with; if anything above
+                    # failed, a retry starts from this message again
+                    offset_id = message.id
+                    entity_posts += 1
+                    if entity_posts >= max_items:
                         break
 
-                except BadRequestError as e:
-                    self.dataset.update_status("Error '%s' while collecting entity %s, skipping" % (e.__class__.__name__, query))
-                    self.flawless = False
+            except ChannelPrivateError:
+                self.dataset.update_status("Entity %s is private, skipping" % query)
+                self.flawless = False
 
-                except ValueError as e:
-                    self.dataset.update_status("Error '%s' while collecting entity %s, skipping" % (str(e), query))
-                    self.flawless = False
+            except (UsernameInvalidError,):
+                self.dataset.update_status("Could not scrape entity '%s', does not seem to exist, skipping" % query)
+                self.flawless = False
 
-                except ChannelPrivateError as e:
-                    self.dataset.update_status(
-                        "QUERY '%s' unable to complete due to error %s. Skipping." % (
-                        query, str(e)))
+            except FloodWaitError as e:
+                self.dataset.update_status("Rate-limited by Telegram: %s; waiting" % str(e))
+                if e.seconds < self.end_if_rate_limited:
+                    # don't block the event loop while waiting
+                    await asyncio.sleep(e.seconds)
+                    continue
+                else:
+                    self.flawless = False
+                    self.no_additional_queries = True
+                    self.dataset.update_status("Telegram wait grown large than %i minutes, ending" % int(e.seconds/60))
                     break
 
-                except TimeoutError:
-                    if retries < 3:
-                        self.dataset.update_status(
-                            "Tried to fetch messages for entity '%s' but timed out %i times. Skipping." % (
-                            query, retries))
-                        self.flawless = False
-                        break
+            except BadRequestError as e:
+                self.dataset.update_status("Error '%s' while collecting entity %s, skipping" % (e.__class__.__name__, query))
+                self.flawless = False
 
-                    self.dataset.update_status(
-                        "Got a timeout from Telegram while fetching messages for entity '%s'. Trying again in %i seconds." % (
-                        query, delay))
-                    time.sleep(delay)
-                    delay *= 2
-                    continue
+            except ValueError as e:
+                self.dataset.update_status("Error '%s' while collecting entity %s, skipping" % (str(e), query))
+                self.flawless = False
 
+            except ChannelPrivateError as e:
+                self.dataset.update_status(
+                    "QUERY '%s' unable to complete due to error %s. Skipping." % (
+                    query, str(e)))
                 break
 
+            except TimeoutError:
+                retries += 1
+                if retries >= 3:
+                    self.dataset.update_status(
+                        "Tried to fetch messages for entity '%s' but timed out %i times. Skipping." % (
+                        query, retries))
+                    self.flawless = False
+                    break
+
+                self.dataset.update_status(
+                    "Got a timeout from Telegram while fetching messages for entity '%s'. Trying again in %i seconds." % (
+                    query, delay))
+                # don't block the event loop while waiting
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+
+            break
+
     async def resolve_groups(self, client, message):
         """
         Recursively resolve references to groups and users
@@ -435,6 +610,11 @@ class SearchTelegram(Search):
         """
         thread = message["_chat"]["username"]
 
+        # these are used repeatedly below
+        sender = message.get("_sender") or {}
+        media = message.get("media") or {}
+        fwd = message.get("fwd_from") or {}
+
         # determine username
         # API responses only include the user *ID*, not the username, and to
         # complicate things further not everyone is a user and not everyone
@@ -442,17 +622,17 @@ class SearchTelegram(Search):
         # last name someone has supplied
         fullname = ""
         username = ""
-        user_id = message["_sender"]["id"] if message.get("_sender") else ""
-        user_is_bot = message["_sender"].get("bot", False) if message.get("_sender") else ""
+        user_id = sender["id"] if sender else ""
+        user_is_bot = sender.get("bot", False) if sender else ""
 
-        if message.get("_sender") and message["_sender"].get("username"):
-            username = message["_sender"]["username"]
+        if sender.get("username"):
+            username = sender["username"]
 
-        if message.get("_sender") and message["_sender"].get("first_name"):
-            fullname += message["_sender"]["first_name"]
+        if sender.get("first_name"):
+            fullname += sender["first_name"]
 
-        if message.get("_sender") and message["_sender"].get("last_name"):
-            fullname += " " + message["_sender"]["last_name"]
+        if sender.get("last_name"):
+            fullname += " " + sender["last_name"]
 
         fullname = fullname.strip()
 
@@ -461,11 +641,11 @@ class SearchTelegram(Search):
         # attachment_data. Since the final result will be serialised as a csv
         # file, we can only store text content. As such some media data is
         # serialised as JSON.
-        attachment_type = SearchTelegram.get_media_type(message["media"])
+        attachment_type = SearchTelegram.get_media_type(media)
         attachment_filename = ""
 
         if attachment_type == "contact":
-            attachment = message["media"]["contact"]
+            attachment = media["contact"]
             attachment_data = json.dumps({property: attachment.get(property) for property in
                                           ("phone_number", "first_name", "last_name", "vcard", "user_id")})
 
@@ -473,9 +653,9 @@ class SearchTelegram(Search):
             # videos, etc
             # This could add a separate routine for videos to make them a
             # separate type, which could then be scraped later, etc
-            attachment_type = message["media"]["document"]["mime_type"].split("/")[0]
+            attachment_type = media["document"]["mime_type"].split("/")[0]
             if attachment_type == "video":
-                attachment = message["media"]["document"]
+                attachment = media["document"]
                 attachment_data = json.dumps({
                     "id": attachment["id"],
                     "dc_id": attachment["dc_id"],
@@ -493,7 +673,7 @@ class SearchTelegram(Search):
             # little of the metadata attached is of interest. Instead, the
             # actual photos may be downloaded via a processor that is run on the
             # search results
-            attachment = message["media"]["photo"]
+            attachment = media["photo"]
             attachment_data = json.dumps({
                 "id": attachment["id"],
                 "dc_id": attachment["dc_id"],
@@ -505,7 +685,7 @@ class SearchTelegram(Search):
             # unfortunately poll results are only available when someone has
             # actually voted on the poll - that will usually not be the case,
             # so we store -1 as the vote count
-            attachment = message["media"]
+            attachment = media
             options = {option["option"]: option["text"] for option in attachment["poll"]["answers"]}
             attachment_data = json.dumps({
                 "question": attachment["poll"]["question"],
@@ -521,7 +701,7 @@ class SearchTelegram(Search):
 
         elif attachment_type == "url":
             # easy!
-            attachment_data = message["media"].get("web_preview", {}).get("url", "")
+            attachment_data = media.get("web_preview", {}).get("url", "")
 
         else:
             attachment_data = ""
@@ -530,22 +710,22 @@ class SearchTelegram(Search):
         forwarded_timestamp = ""
         forwarded_name = ""
         forwarded_username = ""
-        if message.get("fwd_from") and "from_id" in message["fwd_from"] and not (type(message["fwd_from"]["from_id"]) is int):
+        if fwd and "from_id" in fwd and not (type(fwd["from_id"]) is int):
             # forward information is spread out over a lot of places
             # we can identify, in order of usefulness: username, full name,
             # and ID. But not all of these are always available, and not
             # always in the same place either
-            forwarded_timestamp = int(message["fwd_from"]["date"])
-            from_data = message["fwd_from"]["from_id"]
+            forwarded_timestamp = int(fwd["date"])
+            from_data = fwd["from_id"]
 
             if from_data:
                 forwarded_from_id = from_data.get("channel_id", from_data.get("user_id", ""))
 
-            if message["fwd_from"].get("from_name"):
-                forwarded_name = message["fwd_from"].get("from_name")
+            if fwd.get("from_name"):
+                forwarded_name = fwd["from_name"]
 
             if from_data and from_data.get("from_name"):
-                forwarded_name = message["fwd_from"]["from_name"]
+                forwarded_name = fwd["from_name"]
 
             if from_data and ("user" in from_data or "chats" in from_data):
                 # 'resolve entities' was enabled for this dataset
@@ -555,7 +735,7 @@ class SearchTelegram(Search):
 
                     if from_data["user"].get("first_name"):
                         forwarded_name = from_data["user"]["first_name"]
-                    if message["fwd_from"].get("last_name"):
+                    if fwd.get("last_name"):
                         forwarded_name += "  " + from_data["user"]["last_name"]
 
                     forwarded_name = forwarded_name.strip()
@@ -576,14 +756,14 @@ class SearchTelegram(Search):
             "author_is_bot": user_is_bot,
             "body": message["message"],
             "reply_to": message.get("reply_to_msg_id", ""),
-            "views": message["views"] if message["views"] else "",
-            "timestamp": datetime.fromtimestamp(message["date"]).strftime("%Y-%m-%d %H:%M:%S"),
+            "views": message.get("views") or "",
+            "timestamp": _format_timestamp(message["date"]),
             "unix_timestamp": int(message["date"]),
-            "timestamp_edited": datetime.fromtimestamp(message["edit_date"]).strftime("%Y-%m-%d %H:%M:%S") if message["edit_date"] else "",
+            "timestamp_edited": _format_timestamp(message["edit_date"]) if message["edit_date"] else "",
             "unix_timestamp_edited": int(message["edit_date"]) if message["edit_date"] else "",
             "author_forwarded_from_name": forwarded_name,
             "author_forwarded_from_username": forwarded_username,
-            "timestamp_forwarded_from": datetime.fromtimestamp(forwarded_timestamp).strftime("%Y-%m-%d %H:%M:%S") if forwarded_timestamp else "",
+            "timestamp_forwarded_from": _format_timestamp(forwarded_timestamp) if forwarded_timestamp else "",
             "unix_timestamp_forwarded_from": forwarded_timestamp,
             "attachment_type": attachment_type,
             "attachment_data": attachment_data,
@@ -600,24 +780,7 @@ class SearchTelegram(Search):
         :param media:  Media object
         :return str:  Textual identifier of the media type
         """
-        try:
-            return {
-                "NoneType": "",
-                "MessageMediaContact": "contact",
-                "MessageMediaDocument": "document",
-                "MessageMediaEmpty": "",
-                "MessageMediaGame": "game",
-                "MessageMediaGeo": "geo",
-                "MessageMediaGeoLive": "geo_live",
-                "MessageMediaInvoice": "invoice",
-                "MessageMediaPhoto": "photo",
-                "MessageMediaPoll": "poll",
-                "MessageMediaUnsupported": "unsupported",
-                "MessageMediaVenue": "venue",
-                "MessageMediaWebPage": "url"
-            }[media.get("_type", None)]
-        except (AttributeError, KeyError):
-            return ""
+        return _MEDIA_TYPES.get(media.get("_type") if type(media) is dict else None, "")
 
     @staticmethod
     def serialize_obj(input_obj):
@@ -629,44 +792,65 @@ class SearchTelegram(Search):
         those that are not with placeholders and then returns a dictionary that
         can be serialized as JSON.
 
+        Nested objects are serialized iteratively rather than recursively, and
+        how to serialize a value is looked up by its type, since this is
+        called for every single message that is collected.
+
         :param obj:  Object to serialize
         :return:  Serialized object
         """
-        scalars = (int, str, float, list, tuple, set, bool)
-
-        if type(input_obj) in scalars or input_obj is None:
+        if type(input_obj) in _SCALARS or input_obj is None:
             return input_obj
 
-        if type(input_obj) is not dict:
-            obj = input_obj.__dict__
-        else:
-            obj = input_obj.copy()
-
-        mapped_obj = {}
-        for item, value in obj.items():
-            if type(value) is datetime:
-                mapped_obj[item] = value.timestamp()
-            elif type(value).__module__ in ("telethon.tl.types", "telethon.tl.custom.forward"):
-                mapped_obj[item] = SearchTelegram.serialize_obj(value)
-                if type(obj[item]) is not dict:
-                    mapped_obj[item]["_type"] = type(value).__name__
-            elif type(value) is list:
-                mapped_obj[item] = [SearchTelegram.serialize_obj(item) for item in value]
-            elif type(value).__module__[0:8] == "telethon":
-                # some type of internal telethon struct
-                continue
-            elif type(value) is bytes:
-                mapped_obj[item] = value.hex()
-            elif type(value) not in scalars and value is not None:
-                # type we can't make sense of here
+        mapped_root = {}
+        stack = [(mapped_root, input_obj if type(input_obj) is dict else input_obj.__dict__, None)]
+
+        # looked up for every single value, so bind it locally
+        get_kind = _SERIALIZE_KINDS.get
+
+        while stack:
+            mapped_obj, obj, type_name = stack.pop()
+
+            if mapped_obj.__class__ is list:
+                # list items are serialized as if passed to this method
+                # separately: scalars are kept as-is, anything else is
+                # serialized as an object (without a _type)
+                for value in obj:
+                    if value.__class__ in _SCALARS or value is None:
+                        mapped_obj.append(value)
+                    else:
+                        mapped_value = {}
+                        stack.append((mapped_value, value if value.__class__ is dict else value.__dict__, None))
+                        mapped_obj.append(mapped_value)
                 continue
-            elif type(value) is dict:
-                for key, vvalue in value:
-                    mapped_obj[item][key] = SearchTelegram.serialize_obj(vvalue)
-            else:
-                mapped_obj[item] = value
 
-        return mapped_obj
+            for item, value in obj.items():
+                value_type = value.__class__
+                kind = get_kind(value_type)
+                if kind is None:
+                    kind = _SERIALIZE_KINDS[value_type] = _get_serialize_kind(value_type)
+
+                if kind == _KIND_SKIP:
+                    continue
+                elif kind == _KIND_VALUE:
+                    mapped_obj[item] = value
+                elif kind == _KIND_TIMESTAMP:
+                    mapped_obj[item] = value.timestamp()
+                elif kind == _KIND_HEX:
+                    mapped_obj[item] = value.hex()
+                elif kind == _KIND_LIST:
+                    mapped_obj[item] = []
+                    stack.append((mapped_obj[item], value, None))
+                else:
+                    # _KIND_STRUCT
+                    mapped_obj[item] = {}
+                    stack.append((mapped_obj[item], value.__dict__, value_type.__name__))
+
+            # the type is recorded after the object's own attributes
+            if type_name:
+                mapped_obj["_type"] = type_name
+
+        return mapped_root
 
     @staticmethod
     def validate_query(query, request, user):
@@ -687,22 +871,13 @@ class SearchTelegram(Search):
 
         privileged = user.get_value("telegram.can_query_all_messages", False)
 
-        # reformat queries to be a comma-separated list with no wrapping
-        # whitespace
-        whitespace = re.compile(r"\s+")
-        items = whitespace.sub("", query.get("query").replace("\n", ","))
-        if len(items.split(",")) > 25 and not privileged:
+        # reformat queries to be a list of items with no wrapping whitespace
+        items = [item for item in query.get("query").translate(_QUERY_SEPARATORS).split(",") if item]
+        if len(items) > 25 and not privileged:
             raise QueryParametersException("You cannot query more than 25 items at a time.")
 
-        sanitized_items = []
         # handle telegram URLs
-        for item in items.split(","):
-            if not item.strip():
-                continue
-            item = re.sub(r"^https?://t\.me/", "", item)
-            item = re.sub(r"^/?s/", "", item)
-            item = re.sub(r"[/]*$", "", item)
-            sanitized_items.append(item)
+        sanitized_items = [_ENTITY_NAME_RE.match(item).group(1) for item in items]
 
         # the dates need to make sense as a range to search within
         min_date, max_date = query.get("daterange")
@@ -727,15 +902,46 @@ class SearchTelegram(Search):
         Generate a filename for the session file
 
         This is a combination of phone number and API credentials, but hashed
-        so that one cannot actually derive someone's phone number from it.
+        so that one cannot actually derive someone's phone number from it. The
+        API hash is used as the key for the hash, so the same phone number
+        with different credentials gets a different ID.
 
         :param str api_phone:  Phone number for API ID
         :param int api_id:  Telegram API ID
         :param str api_hash:  Telegram API Hash
         :return str: A hash value derived from the input
         """
-        hash_base = api_phone.strip().replace("+", "") + str(api_id).strip() + api_hash.strip()
-        return hashlib.blake2b(hash_base.encode("ascii")).hexdigest()
+        session_hash = hashlib.blake2b(key=api_hash.strip().encode("ascii")[:64], digest_size=16, person=b"4cat-telegram")
+        session_hash.update(api_phone.strip().replace("+", "").encode("ascii"))
+        session_hash.update(b"\x00")
+        session_hash.update(str(api_id).strip().encode("ascii"))
+        return session_hash.hexdigest()
+
+    @staticmethod
+    def get_session_path(api_phone, api_id, api_hash):
+        """
+        Get the path to the session file for the given credentials
+
+        Session files used to be named after an unkeyed, longer hash of the
+        credentials. If such a file exists, it is renamed so that the session
+        can still be used.
+
+        :param str api_phone:  Phone number for API ID
+        :param int api_id:  Telegram API ID
+        :param str api_hash:  Telegram API Hash
+        :return Path:  Path to session file
+        """
+        session_folder = Path(config.get("PATH_ROOT")).joinpath(config.get("PATH_SESSIONS"))
+        session_path = session_folder.joinpath(
+            SearchTelegram.create_session_id(api_phone, api_id, api_hash) + ".session")
+
+        if not session_path.exists():
+            hash_base = api_phone.strip().replace("+", "") + str(api_id).strip() + api_hash.strip()
+            legacy_path = session_folder.joinpath(hashlib.blake2b(hash_base.encode("ascii")).hexdigest() + ".session")
+            if legacy_path.exists():
+                legacy_path.rename(session_path)
+
+        return session_path
 
     @classmethod
     def get_options(cls=None, parent_dataset=None, user=None):
@@ -44,7 +44,7 @@ def authenticate(request, user, **kwargs):
 
 	# store session ID for user so it can be found again for later queries
 	user.set_value("telegram.session", session_id)
-	session_path = Path(config.get('PATH_ROOT')).joinpath(config.get('PATH_SESSIONS'), session_id + ".session")
+	session_path = SearchTelegram.get_session_path(kwargs["api_phone"], kwargs["api_id"], kwargs["api_hash"])
 
 
 	client = None
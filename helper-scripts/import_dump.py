@@ -8,14 +8,18 @@ For /v/, make sure to download this one: https://archive.org/download/archivedmo
 """
 
 import argparse
+import bz2
 import json
 import time
 import csv
+import io
 import sys
 import os
-import re
+import queue
+import threading
 
 from pathlib import Path
+from psycopg2.extras import execute_values
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/..")
 from common.lib.database import Database
@@ -23,7 +27,7 @@ from common.lib.logger import Logger
 
 # parse parameters
 cli = argparse.ArgumentParser()
-cli.add_argument("-i", "--input", required=True, help="File to read from, containing a CSV dump")
+cli.add_argument("-i", "--input", required=True, help="File to read from, containing a CSV dump (may be compressed with bzip2)")
 cli.add_argument("-d", "--datasource", type=str, required=True, help="Datasource ID")
 cli.add_argument("-b", "--board", type=str, required=True, help="Board name")
 cli.add_argument("-s", "--skip_duplicates", type=str, required=True, help="If duplicate posts should be skipped (useful if there's already data in the table)")
@@ -37,14 +41,229 @@ if not Path(args.input).exists() or not Path(args.input).is_file():
 logger = Logger()
 db = Database(logger=logger, appname="queue-dump")
 
-csvnone = re.compile(r"^N$")
+# positions of the columns we use in the dump; these are the same for all
+# boards, except for a few board-specific columns (see below)
+NUM = 0
+SUBNUM = 1
+THREAD_NUM = 2
+OP = 3
+TIMESTAMP = 4
+PREVIEW_W = 7
+PREVIEW_H = 8
+MEDIA_FILENAME = 9
+MEDIA_W = 10
+MEDIA_H = 11
+MEDIA_SIZE = 12
+MEDIA_HASH = 13
+MEDIA_ORIG = 14
+DELETED = 16
+NAME = 19
+TRIP = 20
+TITLE = 21
+COMMENT = 22
+STICKY = 23
+LOCKED = 24
+
+# the import can be resumed with --offset if it fails midway, so there is no
+# need to wait for every commit to be flushed to disk; commits are also only
+# made every so many rows
+db.execute("SET synchronous_commit = off")
+commit_every = 1000000
 
 safe = False
 if args.skip_duplicates.lower() == "true":
 	print("Skipping duplicate rows (ON CONFLICT DO NOTHING).")
 	safe = True
 
-with open(args.input, encoding="utf-8") as inputfile:
+# used to remove NUL bytes from values, which postgres does not accept
+strip_nul = str.maketrans("", "", "\x00")
+
+# columns of posts_4chan that are imported, in the order they are inserted
+post_columns = ("id", "board", "thread_id", "timestamp", "subject", "body", "author", "author_trip", "author_type",
+				"author_type_id", "country_name", "country_code", "image_file", "image_4chan", "image_md5",
+				"image_filesize", "image_dimensions")
+
+
+def insert_posts(post_batch, deleted_batch):
+	"""
+	Insert a batch of posts
+
+	Posts are streamed into a temporary table with COPY, and moved from there
+	to the posts table with a single query, which is much faster than
+	inserting them with INSERT queries. Deleted posts are then also recorded
+	as such, which requires their id_seq.
+
+	:param list post_batch:  Posts to insert, as tuples of values in the order
+	of `post_columns`
+	:param dict deleted_batch:  Posts in the batch that were deleted, as post
+	ID -> timestamp of deletion
+	:return int:  Number of posts added
+	"""
+	cursor = db.get_cursor()
+
+	# every value is quoted, since COPY would read empty unquoted values as
+	# NULL rather than as an empty string
+	buffer = io.StringIO()
+	csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(post_batch)
+	buffer.seek(0)
+
+	# posts are inserted in the order they were in the dump, so their id_seq
+	# follows the same order as when inserting them one by one
+	query = "INSERT INTO posts_4chan (" + ", ".join(post_columns) + ") SELECT " + ", ".join(post_columns) + " FROM posts_4chan_import ORDER BY import_order"
+	if safe:
+		query += " ON CONFLICT DO NOTHING"
+	if deleted_batch:
+		query += " RETURNING id_seq, id"
+
+	cursor.copy_expert("COPY posts_4chan_import (" + ", ".join(post_columns) + ") FROM STDIN WITH (FORMAT csv)", buffer)
+	cursor.execute(query)
+	posts_added = cursor.rowcount
+
+	if deleted_batch:
+		# deleted posts are also recorded in a separate table, which needs the
+		# id_seq of the post. Posts that already existed are not returned by
+		# the insert, so get their id_seq separately
+		id_seqs = {int(post["id"]): post["id_seq"] for post in cursor.fetchall() if int(post["id"]) in deleted_batch}
+		missing = [post_id for post_id in deleted_batch if post_id not in id_seqs]
+		if missing:
+			# passed as an array, so the query text (and plan) is the same no
+			# matter how many posts are missing
+			cursor.execute("SELECT id_seq, id FROM posts_4chan WHERE board = %s AND id = ANY(%s)", (args.board, missing))
+			id_seqs.update({int(post["id"]): post["id_seq"] for post in cursor.fetchall()})
+
+		execute_values(cursor, "INSERT INTO posts_4chan_deleted (id_seq, timestamp_deleted) VALUES %s ON CONFLICT DO NOTHING",
+					   [(id_seq, deleted_batch[post_id]) for post_id, id_seq in id_seqs.items()], page_size=1000)
+
+	cursor.execute("TRUNCATE posts_4chan_import")
+	cursor.close()
+	return posts_added
+
+
+# columns of threads_4chan that are imported, in the order they are inserted
+thread_columns = ("id", "board", "timestamp", "timestamp_scraped", "timestamp_modified", "num_unique_ips", "num_images",
+				  "num_replies", "limit_bump", "limit_image", "is_sticky", "is_closed", "post_last")
+
+
+def upsert_threads(threads_batch):
+	"""
+	Insert or update a batch of threads
+
+	:param list threads_batch:  Threads to upsert, as dictionaries
+	"""
+	if not threads_batch:
+		return
+
+	cursor = db.get_cursor()
+	execute_values(cursor, "INSERT INTO threads_4chan (" + ", ".join(thread_columns) + ") VALUES %s ON CONFLICT (id, board) DO UPDATE SET " +
+				   ", ".join(["%s = EXCLUDED.%s" % (column, column) for column in thread_columns]),
+				   [tuple(thread[column] for column in thread_columns) for thread in threads_batch], page_size=500)
+	cursor.close()
+
+
+def write_batches():
+	"""
+	Write batches of posts and threads to the database
+
+	Runs in a separate thread, so the next batch can be read from the dump
+	while the previous one is being written. Batches are taken from the
+	`batches` queue until `None` is received.
+	"""
+	posts_added = 0
+	while True:
+		batch = batches.get()
+		if batch is None:
+			break
+
+		if writer_errors:
+			# keep emptying the queue, so the reader is not left waiting
+			continue
+
+		try:
+			posts, post_batch, deleted_batch, threads_batch = batch
+			if post_batch:
+				posts_added += insert_posts(post_batch, deleted_batch)
+
+			upsert_threads(threads_batch)
+			print("Inserted posts up to %i (%i new posts added) and %i threads." % (posts, posts_added, len(threads_batch)))
+
+			if posts % commit_every == 0:
+				db.commit()
+				print("Committed rows up to %i; if the import fails after this, restart it with --offset %i." % (posts, posts + 1))
+		except Exception as e:
+			writer_errors.append(e)
+
+
+def read_rows(inputfile, num_fields):
+	"""
+	Read rows from a dump
+
+	The dumps are MySQL exports: every value is quoted, and anything that
+	needs escaping (quotes, newlines, backslashes) is escaped with a
+	backslash, while NULL values are written as an unquoted \\N. So a line
+	without any other backslashes is a complete row that can simply be split
+	on '","', which is a lot faster than the csv module. Other lines are left
+	to the csv module.
+
+	:param inputfile:  File to read from
+	:param int num_fields:  Number of columns in the dump
+	:return:  Generator, yielding rows as lists of values
+	"""
+	lines = iter(inputfile)
+	pushed_back = []
+
+	def fallback_lines():
+		# the line the fast path gave up on, then as many lines as the csv
+		# reader needs to complete the row
+		while True:
+			if pushed_back:
+				yield pushed_back.pop()
+			else:
+				line = next(lines, None)
+				if line is None:
+					return
+				yield line
+
+	reader = csv.reader(fallback_lines(), doublequote=False, escapechar="\\", strict=True)
+
+	for line in lines:
+		row = line.rstrip("\r\n").replace(",\\N", ',"N"')
+		if "\\" not in row and row[:1] == '"' and row[-1:] == '"' and row.count('"') == 2 * num_fields:
+			fields = row[1:-1].split('","')
+			if len(fields) == num_fields:
+				yield fields
+				continue
+
+		pushed_back.append(line)
+		fields = next(reader, None)
+		if fields is None:
+			return
+
+		yield fields
+
+
+# database writes are mostly spent waiting for the database, during which
+# psycopg2 releases the GIL, so a thread is enough to overlap them with
+# parsing the dump. The queue is bounded so the reader cannot get too far
+# ahead of the writer (and fill up memory)
+batches = queue.Queue(maxsize=4)
+writer_errors = []
+writer = threading.Thread(target=write_batches, daemon=True)
+
+# staging table for COPY; temporary, so it is unlogged and dropped when the
+# script ends. import_order is filled in by COPY, in the order of the rows
+# in the dump
+db.execute("CREATE TEMPORARY TABLE posts_4chan_import AS SELECT " + ", ".join(post_columns) + " FROM posts_4chan WITH NO DATA")
+db.execute("ALTER TABLE posts_4chan_import ADD COLUMN import_order BIGSERIAL")
+
+# dumps are distributed as .bz2 files, which can be read without unpacking
+# them first. Otherwise, read the file in big chunks, since it is likely
+# several gigabytes in size
+if Path(args.input).suffix.lower() == ".bz2":
+	inputfile = bz2.open(args.input, "rt", encoding="utf-8", newline="")
+else:
+	inputfile = open(args.input, encoding="utf-8", newline="", buffering=1024 * 1024)
+
+with inputfile:
 
 	if args.board == "v":
 		# The /v/ dump has no headers and slightly different column ordering.
@@ -54,13 +273,21 @@ with open(args.input, encoding="utf-8") as inputfile:
 	else:
 		fieldnames = ("num", "subnum", "thread_num", "op", "timestamp", "timestamp_expired", "preview_orig", "preview_w", "preview_h", "media_filename", "media_w", "media_h", "media_size", "media_hash", "media_orig", "spoiler", "deleted", "capcode", "email", "name", "trip", "title", "comment", "sticky", "locked", "poster_hash", "poster_country", "exif")
 
-	reader = csv.DictReader(inputfile, fieldnames=fieldnames, doublequote=False, escapechar="\\", strict=True)
+	# board-specific columns, or None if the dump does not have them
+	author_type_id_column = fieldnames.index("author_type_id") if "author_type_id" in fieldnames else None
+	poster_country_column = fieldnames.index("poster_country") if "poster_country" in fieldnames else None
+	num_fields = len(fieldnames)
+
+	# rows are read as lists and columns are addressed by index, which is a
+	# lot cheaper than building a dictionary for every row
+	reader = read_rows(inputfile, num_fields)
 	
 	# Skip header
 	next(reader, None)
 
 	posts = 0
-	posts_added = 0
+	post_batch = []
+	deleted_batch = {}
 	threads = {}
 	threads_last_seen = {}
 
@@ -68,23 +295,44 @@ with open(args.input, encoding="utf-8") as inputfile:
 	if args.offset:
 		print("Skipping %s rows." % args.offset)
 
+	# these are used for every row, so look them up once
+	board = sys.intern(args.board)
+	offset = args.offset or 0
+	timestamp_scraped = int(time.time())
+
+	# some columns only have a handful of distinct values; these are kept
+	# here so every batch refers to the same string objects, instead of
+	# holding a separate copy for every post
+	common_values = {}
+
+	writer.start()
 	for post in reader:
-		
+		if not post:
+			# empty line
+			continue
+
 		posts += 1
 
 		# Skip rows if needed. Can be useful when importing didn't go correctly.
-		if args.offset and posts < args.offset:
+		if posts < offset:
 			continue
 		
-		post = {k: csvnone.sub("", post[k]) if post[k] else None for k in post}
+		# empty values are read as None, and 'N' (which is how the dump
+		# marks a NULL value) as an empty string
+		post = [("" if value == "N" else value) if value else None for value in post]
+		if len(post) < num_fields:
+			# missing columns are empty
+			post.extend([None] * (num_fields - len(post)))
 
 		# We collect thread data first, even though we might skip this post
-		if post["thread_num"] not in threads:
-			threads[post["thread_num"]] = {
-				"id": post["thread_num"],
-				"board": args.board,
+		thread_num = post[THREAD_NUM]
+		thread = threads.get(thread_num)
+		if thread is None:
+			thread = threads[thread_num] = {
+				"id": thread_num,
+				"board": board,
 				"timestamp": 0,
-				"timestamp_scraped": int(time.time()),
+				"timestamp_scraped": timestamp_scraped,
 				"timestamp_modified": 0,
 				"num_unique_ips": -1,
 				"num_images": 0,
@@ -95,98 +343,95 @@ with open(args.input, encoding="utf-8") as inputfile:
 				"is_closed": False,
 				"post_last": 0
 			}
-		
-		if post["op"] == "1":
-			threads[post["thread_num"]]["timestamp"] = post["timestamp"]
-			threads[post["thread_num"]]["is_sticky"] = post["sticky"] == "1"
-			threads[post["thread_num"]]["is_closed"] = post["locked"] == "1"
-
-		if post["media_filename"]:
-			threads[post["thread_num"]]["num_images"] += 1
-
-		threads[post["thread_num"]]["num_replies"] += 1
-		threads[post["thread_num"]]["post_last"] = post["num"]
-		threads[post["thread_num"]]["timestamp_modified"] = post["timestamp"]
-
-		# We reset the count of when we last seen this thread to 1
-		# to prevent committing incomplete thread data.
-		# Increase the count for the other threads.
-		threads_last_seen[post["thread_num"]] = 0
-		for k, v in threads_last_seen.items():
-			threads_last_seen[k] += 1
-		
-		if post["media_filename"] and len({"media_w", "media_h", "preview_h", "preview_w"} - set(post.keys())) == 0:
-			dimensions = {"w": post["media_w"], "h": post["media_h"], "tw": post["preview_w"], "th": post["preview_h"]}
-		else:
-			dimensions = {}
 
-		if post["subnum"] != "0":
-			# ghost post
-			continue
+		if post[OP] == "1":
+			thread["timestamp"] = post[TIMESTAMP]
+			thread["is_sticky"] = post[STICKY] == "1"
+			thread["is_closed"] = post[LOCKED] == "1"
 
-		post_data = {
-			"id": post["num"],
-			"board": args.board,
-			"thread_id": post["thread_num"],
-			"timestamp": post["timestamp"],
-			"subject": post.get("title", ""),
-			"body": post.get("comment", ""),
-			"author": post.get("name", ""),
-			"author_trip": post.get("trip", ""),
-			"author_type": post.get("author_type", ""),
-			"author_type_id": post["author_type_id"] if post["author_type_id"] != "" else "N",
-			"country_name": "",
-			"country_code": post.get("poster_country", ""),
-			"image_file": post["media_filename"],
-			"image_4chan": post["media_orig"],
-			"image_md5": post.get("media_hash", ""),
-			"image_filesize": post.get("media_size", 0),
-			"image_dimensions": json.dumps(dimensions)
-		}
-
-		post_data = {k: str(v).replace("\x00", "") for k, v in post_data.items()}
-		
-		if post["deleted"] == "0":
-			new_post = db.insert("posts_4chan", post_data, commit=False, safe=safe)
-		
-		else:
-			
-			# database.py throws a TypeError when the post already exists and we're not updating, since it didn't return a row. However, we need the id_seq field for deleted posts. In this case, catch the TypeError and simply retrieve the id_seq from the database.
-			try:
-				new_id = db.insert("posts_4chan", post_data, commit=False, safe=safe, return_field="id_seq")
-			except TypeError:
-				
-				r = db.fetchone("SELECT id_seq FROM posts_4chan WHERE board = '%s' AND id = %i;" % (args.board, int(post["num"])))
-				new_id = r["id_seq"] if r else None
-			if new_id:
-				new_post = db.insert("posts_4chan_deleted", {"id_seq": new_id, "timestamp_deleted": post["timestamp"]}, safe=True)
-
-		posts_added += new_post
+		if post[MEDIA_FILENAME]:
+			thread["num_images"] += 1
+
+		thread["num_replies"] += 1
+		thread["post_last"] = post[NUM]
+		thread["timestamp_modified"] = post[TIMESTAMP]
+
+		# We record when we last saw this thread to prevent committing
+		# incomplete thread data. This is the number of the row, so we do not
+		# need to update all other threads for every row
+		threads_last_seen[thread_num] = posts
 		
+		# ghost posts are not imported, but they do count towards the thread's
+		# replies and images above, so this cannot be checked any earlier.
+		# They are also counted as rows below, so that batches are still sent
+		# (and committed) when a ghost post happens to be every 10000th row
+		if post[SUBNUM] == "0":
+			# most posts have no image, and thus no dimensions; no need to encode
+			# an empty dictionary as JSON for each of those
+			if post[MEDIA_FILENAME]:
+				dimensions = json.dumps({"w": post[MEDIA_W], "h": post[MEDIA_H], "tw": post[PREVIEW_W], "th": post[PREVIEW_H]})
+			else:
+				dimensions = "{}"
+
+			author_type_id = post[author_type_id_column] if author_type_id_column is not None else ""
+			author_type_id = common_values.setdefault(author_type_id, author_type_id) if author_type_id != "" else "N"
+			country_code = post[poster_country_column] if poster_country_column is not None else ""
+			country_code = common_values.setdefault(country_code, country_code)
+
+			# values in the order of post_columns; no need to build a dictionary
+			# for every post just to read the values out again
+			post_values = (
+				post[NUM],
+				board,
+				post[THREAD_NUM],
+				post[TIMESTAMP],
+				post[TITLE],
+				post[COMMENT],
+				post[NAME],
+				post[TRIP],
+				"",
+				author_type_id,
+				"",
+				country_code,
+				post[MEDIA_FILENAME],
+				post[MEDIA_ORIG],
+				post[MEDIA_HASH],
+				post[MEDIA_SIZE],
+				dimensions
+			)
+
+			# NUL bytes cannot be stored in a text column, but few values contain
+			# them, so only those (and missing values) need converting
+			post_batch.append(tuple(value if value is not None and "\x00" not in value else str(value).translate(strip_nul)
+									for value in post_values))
+			if post[DELETED] != "0":
+				deleted_batch[int(post[NUM])] = post[TIMESTAMP]
+
 		# Insert per every 10000 posts
 		if posts > 0 and posts % 10000 == 0:
-			print("Committing posts %i - %i. %i new posts added. " % (posts - 10000, posts, posts_added), end="")
-
 			# We're commiting the threads we didn't encounter in the last 100.000 posts. We're assuming they're complete and won't be seen in this archive anymore.
 			# This is semi-necessary to prevent RAM hogging.
-			threads_committed = 0
-			for thread_seen, last_seen in threads_last_seen.items():
-				if last_seen > 10000:
-					db.upsert("threads_4chan", data=threads[thread_seen], commit=False, constraints=["id", "board"])
-					threads.pop(thread_seen)
-					threads_committed += 1
+			threads_batch = [threads.pop(thread_seen) for thread_seen, last_seen in threads_last_seen.items() if posts - last_seen >= 10000]
 
 			# Remove committed threads from the last seen list
-			threads_last_seen = {k: v for k, v in threads_last_seen.items() if v < 10000}
+			threads_last_seen = {k: v for k, v in threads_last_seen.items() if posts - v < 10000}
+
+			# the writer thread takes it from here
+			batches.put((posts, post_batch, deleted_batch, threads_batch))
+			post_batch = []
+			deleted_batch = {}
+
+			if writer_errors:
+				break
 
-			print("Comitting %i threads (%i still updating)." % (threads_committed, len(threads)))
-			
-			db.commit()
+	# Add the last posts and threads as well
+	print("Committing leftover posts and threads")
+	batches.put((posts, post_batch, deleted_batch, list(threads.values())))
+	batches.put(None)
+	writer.join()
 
-	# Add the last threads as well
-	print("Comitting leftover threads")
-	for thread in threads.values():
-		db.upsert("threads_4chan", data=thread, commit=False, constraints=["id", "board"])
+	if writer_errors:
+		raise writer_errors[0]
 
 	db.commit()
 
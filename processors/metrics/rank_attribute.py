@@ -3,8 +3,8 @@ Generate ranking per post attribute
 """
 import re
 
-from collections import OrderedDict
-from itertools import islice, chain
+from collections import Counter
+from itertools import chain
 
 from backend.abstract.processor import BasicProcessor
 from common.lib.helpers import UserInput, convert_to_int, get_interval_descriptor
@@ -14,6 +14,14 @@ __credits__ = ["Stijn Peeters"]
 __maintainer__ = "Stijn Peeters"
 __email__ = "4cat@oilab.eu"
 
+# compiled once, since extract() is called for every value of every item
+_LINK_RE = re.compile(r"https?://[^\s\]()]+")
+# for hashtags, links are matched by the same pattern, in a single scan, so
+# that the '#fragment' of a link is not mistaken for a hashtag
+_ENTITY_RE = re.compile(r"(?P<urls>https?://[^\s\]()]+)|#(?P<hashtags>[a-zA-Z0-9_]+)")
+_WWW_RE = re.compile(r"^www\.")
+
+
 class AttributeRanker(BasicProcessor):
 	"""
 	Count occurrence of values for a given post attribute for a given time
@@ -126,27 +134,32 @@ class AttributeRanker(BasicProcessor):
 		# This is needed to check for URLs in the "domain" and "url" columns for Reddit submissions
 		datasource = self.source_dataset.parameters.get("datasource")
 
-		# we need to be able to order the values later, chronologically, so use
-		# and OrderedDict; all frequencies go into this variable
-		items = OrderedDict()
+		# all frequencies go into this variable, one counter per time unit;
+		# these are sorted chronologically later
+		items = {}
 
 		# if we're interested in overall top-ranking items rather than a
 		# per-period ranking, we need to do a first pass in which all posts are
 		# inspected to determine those overall top-scoring items
-		overall_top = {}
+		overall_top = Counter()
 		if rank_style == "overall":
 			self.dataset.update_status("Determining overall top-%i items" % cutoff)
 			for post in self.source_dataset.iterate_items(self):
 				values = self.get_values(post, columns, filter, split_comma, extract)
-				for value in values:
-					if to_lowercase:
-						value = value.lower()
-					if value not in overall_top:
-						overall_top[value] = 0
+				if not values:
+					continue
 
-					overall_top[value] += convert_to_int(post.get(weighby, 1), 1)
+				if to_lowercase:
+					values = [value.lower() for value in values]
+
+				weight = convert_to_int(post.get(weighby, 1), 1)
+				if weight == 1:
+					overall_top.update(values)
+				else:
+					for value in values:
+						overall_top[value] += weight
 
-			overall_top = sorted(overall_top, key=lambda item: overall_top[item], reverse=True)[0:cutoff]
+			overall_top = {item for item, frequency in overall_top.most_common(cutoff)}
 
 		# now for the real deal
 		self.dataset.update_status("Reading source file")
@@ -160,50 +173,38 @@ class AttributeRanker(BasicProcessor):
 				return
 
 			if time_unit not in items:
-				items[time_unit] = OrderedDict()
+				items[time_unit] = Counter()
 
 			# get values from post
 			values = self.get_values(post, columns, filter, split_comma, extract)
+			if not values:
+				continue
 
 			# keep track of occurrences of found items per relevant time period
-			for value in values:
-				if to_lowercase:
-						value = value.lower()
-				
-				if rank_style == "overall" and value not in overall_top:
-					continue
+			if to_lowercase:
+				values = [value.lower() for value in values]
 
-				if value not in items[time_unit]:
-					items[time_unit][value] = 0
+			if rank_style == "overall":
+				values = [value for value in values if value in overall_top]
 
-				items[time_unit][value] += convert_to_int(post.get(weighby, 1))
+			weight = convert_to_int(post.get(weighby, 1))
+			if weight == 1:
+				items[time_unit].update(values)
+			else:
+				for value in values:
+					items[time_unit][value] += weight
 
-		# sort by time and frequency
+		# sort by time and frequency, and convert to a flat list
+		# most_common() sorts by frequency, and also takes care of the cutoff
+		# if one was set; the counters are discarded once converted
 		self.dataset.update_status("Sorting items")
-		sorted_items = OrderedDict((key, items[key]) for key in sorted(items.keys()))
-		for time_unit in sorted_items:
-			sorted_unit = OrderedDict((item, sorted_items[time_unit][item]) for item in
-									  sorted(sorted_items[time_unit], reverse=True,
-											 key=lambda key: sorted_items[time_unit][key]))
-			sorted_items[time_unit].clear()
-			sorted_items[time_unit].update(sorted_unit)
-
-			if cutoff > 0:
-				# OrderedDict's API sucks and really needs some extra
-				# convenience methods
-				sorted_items[time_unit] = OrderedDict(islice(sorted_items[time_unit].items(), cutoff))
-
-		# convert to flat list
 		rows = []
-		for time_unit in sorted_items:
-			for item in sorted_items[time_unit]:
-				row = {
-					"date": time_unit,
-					"item": item,
-					"value": sorted_items[time_unit][item]
-				}
-
-				rows.append(row)
+		for time_unit in sorted(items.keys()):
+			rows.extend({
+				"date": time_unit,
+				"item": item,
+				"value": frequency
+			} for item, frequency in items.pop(time_unit).most_common(cutoff if cutoff > 0 else None))
 
 		# write as csv
 		if rows:
@@ -235,8 +236,6 @@ class AttributeRanker(BasicProcessor):
 				item_values = list(chain(*[self.extract(v, extract) for v in item_values]))
 
 			if item_values:
-				print(values)
-				print(item_values)
 				values.extend(item_values)
 
 		if not values:
@@ -255,24 +254,30 @@ class AttributeRanker(BasicProcessor):
 		:param str look_for:  What type of value to look for
 		:return list:  Found values
 		"""
-		link_regex = re.compile(r"https?://[^\s\]()]+")
-		www_regex = re.compile(r"^www\.")
-		values = []
+		if look_for in ("urls", "hostnames"):
+			# a substring check is much cheaper than the regex for the many
+			# values that contain no links at all
+			if "http" not in value:
+				return []
 
-		if look_for in ("url", "hostname"):
-			links = link_regex.findall(value)
+			links = _LINK_RE.findall(value)
 
-			if look_for == "hostname":
+			if look_for == "hostnames":
+				values = []
 				for urlbits in links:
 					urlbits = urlbits.split("/")
 					if len(urlbits) >= 3:
-						values.append(www_regex.sub("", urlbits[2]))
+						values.append(_WWW_RE.sub("", urlbits[2]))
+
+				return values
 			else:
-				values += list(links)
+				return links
 
 		elif look_for == "hashtags":
-			hashtags = list(re.findall(r"#([a-zA-Z0-9_]+)", value))
-			return hashtags
+			if "#" not in value:
+				return []
+
+			return [match.group("hashtags") for match in _ENTITY_RE.finditer(value) if match.lastgroup == "hashtags"]
 
 		else:
 			return [value]
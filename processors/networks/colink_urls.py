@@ -107,8 +107,9 @@ class URLCoLinker(BasicProcessor):
 				links[unit_id] = []
 
 			# in the case of post-level analysis, this is identical to just
-			# post_links on its own
-			links[unit_id] = [*post_links, *links[unit_id]]
+			# post_links on its own; extend in place rather than building a
+			# new list for every post in a thread
+			links[unit_id].extend(post_links)
 
 		# create co-link pairs from all links per co-link unit (thread or post)
 		self.dataset.update_status("Finding common URLs")
@@ -2,13 +2,19 @@
 Generate network of wikipedia pages + categories in posts
 """
 import re
+import time
+import shelve
 import requests
 
+from collections import defaultdict
+from urllib.parse import unquote
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from backend.abstract.processor import BasicProcessor
 from common.lib.helpers import UserInput
-from lxml import etree
-from lxml.cssselect import CSSSelector as css
-from io import StringIO
+from common.lib.exceptions import ProcessorInterruptedException
+import common.config_manager as config
 
 import networkx as nx
 
@@ -17,6 +23,15 @@ __credits__ = ["Stijn Peeters", "Sal Hagen"]
 __maintainer__ = "Stijn Peeters"
 __email__ = "4cat@oilab.eu"
 
+# we use this to extract URLs; compiled once per process
+# links may contain commas, but never end with one, so trailing commas
+# (e.g. from an enumeration in the post) are not captured
+_WIKI_LINK_RE = re.compile(r"https?://en\.wikipedia\.org/wiki/[^\s.]*[^\s.,]")
+
+# how long fetched page categories are cached for, in seconds
+_CACHE_TTL = 30 * 86400
+
+
 class WikiNetworker(BasicProcessor):
 	"""
 	Generate URL co-link network
@@ -58,16 +73,10 @@ class WikiNetworker(BasicProcessor):
 		if type(columns) is not list:
 			columns = [columns]
 
-		# we use these to extract URLs and host names if needed
-		link_regex = re.compile(r"https?://en.wikipedia\.org/wiki/[^\s.]+")
-		wiki_page = re.compile(r"[\[\[[^\]]+\]\]")
-		category_regex = re.compile(r"\[\[Category:[^\]]+\]\]")
-		trailing_comma = re.compile(r",$")
-
-		links = {}
-		all_categories = {}
+		links = defaultdict(int)
+		all_categories = defaultdict(int)
 		errors = 0
-		page_categories = {}
+		page_categories = defaultdict(set)
 		page_links = {}
 		deep_pages = {}
 		processed = 0
@@ -83,114 +92,163 @@ class WikiNetworker(BasicProcessor):
 			if not post["body"]:
 				continue
 
-			wiki_links = link_regex.findall(" ".join([post[column] for column in columns]))
+			# most items contain no Wikipedia links at all; a plain substring
+			# check is much cheaper than running the regex on those
+			text = " ".join([post[column] for column in columns])
+			wiki_links = _WIKI_LINK_RE.findall(text) if "en.wikipedia.org/wiki/" in text else []
 
 			# if the result has an explicit url per post, take that into
 			# account as well
-			if "url" in post and post["url"] and link_regex.match(post["url"]):
-				wiki_links.append(link_regex.findall(post["url"]))
+			if "url" in post and post["url"] and _WIKI_LINK_RE.match(post["url"]):
+				wiki_links.extend(_WIKI_LINK_RE.findall(post["url"]))
 
-			wiki_links = [trailing_comma.sub("", link) for link in wiki_links]
-
-			# Encode the URLs, e.g. replace commas with '%2c', so it makes a nice gdf file
-			wiki_links = [link.replace(",", "%2c").replace("'", "").replace('"',"").replace("\\_","_") for link in wiki_links]
-			wiki_links = sorted(set(wiki_links))
-
-			for link in wiki_links:
-				link = "/wiki/".join(link.split("/wiki/")[1:]).split("#")[0]
-				if link not in links:
-					links[link] = 0
+			if not wiki_links:
+				continue
 
-				links[link] += 1
+			# get the page names from the URLs; a set, so each page is counted
+			# only once per item. Encode the names, e.g. replace commas with
+			# '%2c', so they make nice node labels
+			pages = {link.split("/wiki/", 1)[1].split("#")[0].replace(",", "%2c").replace("'", "").replace('"', "").replace("\\_", "_") for link in wiki_links}
+			for page in pages:
+				links[page] += 1
 
 			# Limit to the first 10,000 links extracted
 			if len(links) >= 10000:
 				break
 
-		# just a helper function to get the HTML content of a node
-		def stringify_children(node):
-			from lxml.etree import tostring
-			from itertools import chain
-			parts = ([node.text] +
-					 list(chain(*([c.text, tostring(c), c.tail] for c in node.getchildren()))) +
-					 [node.tail])
-			# filter removes possible Nones in texts and tails
-			return ''.join(filter(None, parts))
-
-		counter = 0
-
-		self.dataset.update_status("Fetching categories from Wikipedia API...")
-		for link in links:
-			if link not in page_categories:
-				if self.interrupted:
-					raise ProcessorInterruptedException("Interrupted while fetching data from Wikipedia")
-
-				page_categories[link] = set()
-				self.dataset.update_status(
-					"Fetching categories from Wikipedia API, page %i of %i" % (counter, len(links)))
-				counter += 1
-
-				# fetch wikipedia source
-				url = "https://en.wikipedia.org/w/index.php?title=" + link + "&action=edit"
-				try:
-					page = requests.get(url)
-				except requests.RequestException:
-					errors += 1
-					continue
-
-				if page.status_code != 200:
-					errors += 1
-					continue
-
-				# get link to image file from HTML returned
-				parser = etree.HTMLParser()
-				tree = etree.parse(StringIO(page.content.decode("utf-8")), parser)
-
+		# the MediaWiki API can return the categories for up to 50 pages per
+		# request; these requests are still made in parallel, sharing a
+		# keep-alive session, while the results are processed one by one in
+		# this thread
+		session = requests.Session()
+
+		def fetch_categories(batch):
+			"""
+			Get categories for a batch of pages from the Wikipedia API
+
+			:param dict batch:  Page titles, mapped to the links they were
+			extracted as
+			:return dict:  Links, mapped to a set of category names, or `None`
+			if the categories could not be fetched
+			"""
+			params = {
+				"action": "query",
+				"prop": "categories",
+				"cllimit": "max",
+				"clshow": "!hidden",
+				"format": "json",
+				"formatversion": 2,
+				"titles": "|".join(batch)
+			}
+
+			categories = {}
+			while True:
 				try:
-					wiki_source = stringify_children(css("#wpTextbox1")(tree)[0])
-				except IndexError:
-					# not a source page?
-					errors += 1
-					continue
-
-				# extract category names from category link syntax
-				categories = category_regex.findall(wiki_source)
-				categories = set([":".join(category.split(":")[1:])[:-2].split("|")[0] for category in categories])
-
-				# save category links
-				for category in categories:
-
-					# Add " (cat)" to the category strings.
-					# This is needed because pages can sometimes have the same name as the category.
-					# This will result in a faulty graph, since there's duplicate nodes.
-
-					category += " (cat)"
-
-					if category not in all_categories:
-						all_categories[category] = 0
-
-					all_categories[category] += 1
-					page_categories[link].add(category)
+					response = session.get("https://en.wikipedia.org/w/api.php", params=params)
+					result = response.json() if response.status_code == 200 else None
+				except (requests.RequestException, ValueError):
+					result = None
+
+				if not result or "query" not in result:
+					return None
+
+				# titles may have been normalised by the API (e.g. '_' -> ' ')
+				normalised = {title["to"]: title["from"] for title in result["query"].get("normalized", [])}
+				for page in result["query"].get("pages", []):
+					title = normalised.get(page["title"], page["title"])
+					if title not in batch or page.get("missing") or page.get("invalid"):
+						continue
+
+					found = categories.setdefault(batch[title], set())
+					for category in page.get("categories", []):
+						found.add(category["title"].split(":", 1)[-1])
+
+				# with many categories, results may be spread over multiple
+				# responses
+				if "continue" not in result:
+					return categories
+
+				params.update(result["continue"])
+
+		# categories fetched earlier are cached on disk, keyed by page title,
+		# so pages that occur in multiple datasets need only be fetched once
+		found = {}
+		cache_path = Path(config.get("PATH_ROOT"), config.get("PATH_DATA"), ".wikipedia-categories")
+		with shelve.open(str(cache_path)) as cache:
+			titles = []
+			for title, link in {unquote(link): link for link in links}.items():
+				cached = cache.get(title)
+				if cached and time.time() - cached[0] < _CACHE_TTL:
+					found[link] = cached[1]
+				else:
+					titles.append((title, link))
+
+			batches = [dict(titles[i:i + 50]) for i in range(0, len(titles), 50)]
+			counter = 0
+			last_update = 0
+
+			self.dataset.update_status("Fetching categories from Wikipedia API...")
+			with ThreadPoolExecutor(max_workers=8) as pool:
+				fetches = {pool.submit(fetch_categories, batch): batch for batch in batches}
+				for fetch in as_completed(fetches):
+					if self.interrupted:
+						for pending in fetches:
+							pending.cancel()
+						raise ProcessorInterruptedException("Interrupted while fetching data from Wikipedia")
+
+					# status updates are database writes, so limit them to one
+					# per second
+					counter += len(fetches[fetch])
+					if time.monotonic() - last_update > 1 or counter == len(titles):
+						self.dataset.update_status(
+							"Fetching categories from Wikipedia API, page %i of %i" % (counter, len(titles)))
+						last_update = time.monotonic()
+
+					categories = fetch.result()
+					if categories is None:
+						errors += len(fetches[fetch])
+						continue
+
+					# pages not included in the result do not exist
+					errors += len(fetches[fetch]) - len(categories)
+
+					for link, link_categories in categories.items():
+						cache[unquote(link)] = (time.time(), link_categories)
+						found[link] = link_categories
+
+		# save category links
+		for link, link_categories in found.items():
+			for category in link_categories:
+				# Add " (cat)" to the category strings.
+				# This is needed because pages can sometimes have the same name as the category.
+				# This will result in a faulty graph, since there's duplicate nodes.
+				category += " (cat)"
+				all_categories[category] += 1
+				page_categories[link].add(category)
 
 		# write GEXF file
+		# labels are computed once per page or category, and nodes and edges
+		# are added in bulk rather than one call per node
+		page_labels = {page: page.replace("_", " ") for page in links}
+		category_labels = {category: category.replace("_", " ") for category in all_categories}
+
 		ids = {}
-		id_no = 0
-		for page in page_categories:
-			network.add_node(id_no, label=page.replace("_", " "), **({"weight": links[page], "type": "page"}))
-			ids[page.replace("_", " ")] = id_no
-			id_no += 1
+		# every link gets a node, even if no categories could be fetched for it
+		for label in page_labels.values():
+			ids[label] = len(ids)
 
-		for category in all_categories:
-			network.add_node(id_no, label=category.replace("_", " "), **({"weight": all_categories[category], "type": "category"}))
-			ids[category.replace("_", " ")] = id_no
-			id_no += 1
+		for label in category_labels.values():
+			ids[label] = len(ids)
 
-		for page in page_categories:
-			for category in page_categories[page]:
-				network.add_edge(ids[page.replace("_", " ")], ids[category.replace("_", " ")], **({"weight": all_categories[category]}))
+		network.add_nodes_from((ids[page_labels[page]], {"label": page_labels[page], "weight": links[page], "type": "page"}) for page in links)
+		network.add_nodes_from((ids[category_labels[category]], {"label": category_labels[category], "weight": all_categories[category], "type": "category"}) for category in all_categories)
+		network.add_edges_from((ids[page_labels[page]], ids[category_labels[category]], {"weight": all_categories[category]})
+							   for page in page_categories for category in page_categories[page])
 
 		self.dataset.update_status("Writing network file")
-		nx.write_gexf(network, self.dataset.get_results_path())
+		with self.dataset.get_results_path().open("wb", buffering=1024 * 1024) as outfile:
+			nx.write_gexf(network, outfile)
+
 		self.dataset.finish(len(network.nodes))
 
 
@@ -2,11 +2,8 @@
 Download images from Telegram message attachments
 """
 import asyncio
-import hashlib
 import json
 
-from pathlib import Path
-
 from telethon import TelegramClient
 
 import common.config_manager as config
@@ -14,6 +11,7 @@ from backend.abstract.processor import BasicProcessor
 from common.lib.exceptions import ProcessorInterruptedException
 from common.lib.helpers import UserInput
 from common.lib.dataset import DataSet
+from datasources.telegram.search_telegram import SearchTelegram
 
 __author__ = "Stijn Peeters"
 __credits__ = ["Stijn Peeters"]
@@ -121,9 +119,8 @@ class TelegramImageDownloader(BasicProcessor):
         """
         # prepare telegram client parameters
         query = self.source_dataset.top_parent().parameters
-        hash_base = query["api_phone"].replace("+", "") + query["api_id"] + query["api_hash"]
-        session_id = hashlib.blake2b(hash_base.encode("ascii")).hexdigest()
-        session_path = Path(config.get('PATH_ROOT')).joinpath(config.get('PATH_SESSIONS'), session_id + ".session")
+        # this also renames the session file if it still has an old-style name
+        session_path = SearchTelegram.get_session_path(query["api_phone"], query["api_id"], query["api_hash"])
         amount = self.parameters.get("amount")
         with_thumbnails = self.parameters.get("video-thumbnails")
         client = None
@@ -0,0 +1,91 @@
+"""
+Tests for the Telegram data source
+"""
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("telethon")
+from datasources.telegram.search_telegram import SearchTelegram
+
+
+def legacy_serialize_obj(input_obj):
+    """
+    serialize_obj() as it was before it was made iterative, to compare with
+    """
+    scalars = (int, str, float, list, tuple, set, bool)
+
+    if type(input_obj) in scalars or input_obj is None:
+        return input_obj
+
+    if type(input_obj) is not dict:
+        obj = input_obj.__dict__
+    else:
+        obj = input_obj.copy()
+
+    mapped_obj = {}
+    for item, value in obj.items():
+        if type(value) is datetime:
+            mapped_obj[item] = value.timestamp()
+        elif type(value).__module__ in ("telethon.tl.types", "telethon.tl.custom.forward"):
+            mapped_obj[item] = legacy_serialize_obj(value)
+            if type(obj[item]) is not dict:
+                mapped_obj[item]["_type"] = type(value).__name__
+        elif type(value) is list:
+            mapped_obj[item] = [legacy_serialize_obj(item) for item in value]
+        elif type(value).__module__[0:8] == "telethon":
+            continue
+        elif type(value) is bytes:
+            mapped_obj[item] = value.hex()
+        elif type(value) not in scalars and value is not None:
+            continue
+        else:
+            mapped_obj[item] = value
+
+    return mapped_obj
+
+
+def make_object(name, module, **attributes):
+    """
+    Create an object of a new class with the given name and module
+    """
+    obj = type(name, (), {"__module__": module})()
+    obj.__dict__.update(attributes)
+    return obj
+
+
+def telethon_object(name, **attributes):
+    return make_object(name, "telethon.tl.types", **attributes)
+
+
+def other_object(**attributes):
+    return make_object("Other", __name__, **attributes)
+
+
+def internal_object():
+    return make_object("Internal", "telethon.client.messages")
+
+
+@pytest.mark.parametrize("message", [
+    telethon_object("Message", id=1, text="hello", date=datetime(2022, 1, 1), raw=b"\x01\x02", flag=True, empty=None),
+    telethon_object("Message", id=2, entities=[other_object(a=1)]),
+    telethon_object("Message", id=3, entities=[telethon_object("MessageEntityUrl", offset=0, length=5)]),
+    telethon_object("Message", id=4, entities=[[1, 2], (3, 4), {"x": 1, "when": datetime(2022, 1, 1)}, None, "s"]),
+    telethon_object("Message", id=5, entities=[other_object(nested=[other_object(b=2, client=internal_object())])]),
+    telethon_object("Message", id=6, peer_id=telethon_object("PeerChannel", channel_id=10),
+                    fwd_from=telethon_object("MessageFwdHeader", from_id=telethon_object("PeerUser", user_id=5),
+                                             date=datetime(2021, 6, 1))),
+    telethon_object("Message", id=7, client=internal_object(), extra={"dropped": True}, other=other_object(c=3)),
+    {"id": 8, "media": telethon_object("MessageMediaPhoto", photo=telethon_object("Photo", id=9, sizes=[
+        telethon_object("PhotoSize", w=10, h=20)]))},
+])
+def test_serialize_obj_matches_legacy(message):
+    """
+    Serialized messages should be exactly as they were before serialize_obj()
+    was rewritten, including nested lists and key order
+    """
+    serialized = SearchTelegram.serialize_obj(message)
+    legacy = legacy_serialize_obj(message)
+
+    assert serialized == legacy
+    assert repr(serialized) == repr(legacy)
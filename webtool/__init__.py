@@ -68,19 +68,22 @@ openapi = OpenAPICollector(app)
 # initialize rate limiter
 limiter = Limiter(app, key_func=get_remote_address)
 
+# get all settings in one go, rather than with a query per setting
+flask_settings = config.get_all()
+
 # make sure a secret key was set in the config file, for secure session cookies
-if config.get("flask.secret_key") == "REPLACE_THIS":
+if flask_settings.get("flask.secret_key") == "REPLACE_THIS":
     raise Exception("You need to set a FLASK_SECRET in config.py before running the web tool.")
 
 # initialize login manager
 app.config.from_mapping({
-    "FLASK_APP": config.get("flask.flask_app"),
-    "SECRET_KEY": config.get("flask.secret_key"),
-    "SERVER_NAME": config.get("flask.server_name"),
-    "SERVER_HTTPS": config.get("flask.https"),
-    "HOSTNAME_WHITELIST": config.get("flask.autologin.hostnames"),
-    "HOSTNAME_WHITELIST_NAME": config.get("flask.autologin.name"),
-    "HOSTNAME_WHITELIST_API": config.get("flask.autologin.api"),
+    "FLASK_APP": flask_settings.get("flask.flask_app"),
+    "SECRET_KEY": flask_settings.get("flask.secret_key"),
+    "SERVER_NAME": flask_settings.get("flask.server_name"),
+    "SERVER_HTTPS": flask_settings.get("flask.https"),
+    "HOSTNAME_WHITELIST": flask_settings.get("flask.autologin.hostnames"),
+    "HOSTNAME_WHITELIST_NAME": flask_settings.get("flask.autologin.name"),
+    "HOSTNAME_WHITELIST_API": flask_settings.get("flask.autologin.api"),
 })
 login_manager.anonymous_user = partial(User.get_by_name, db=db, name="anonymous")
 login_manager.init_app(app)